@@ -1,53 +1,116 @@
-import json
+import asyncio
+import os
+import socket
+import time
+import weakref
+import orjson
+import redis.asyncio as aioredis
+from redis.exceptions import RedisError
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
-from .models import ChatRoom, Message
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.db import IntegrityError, transaction
+from django.db.models import Count
+from django.utils import timezone
+from .models import ChatRoom, Message, MESSAGE_PAGE_SIZE
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Minimum interval between forwarded "is typing" events from one connection
+TYPING_DEBOUNCE_SECONDS = 1.0
+
+# Group of all lobby sockets; deliberately outside the chat_<room> namespace so a
+# group room that happens to be called "lobby" doesn't share it
+LOBBY_GROUP_NAME = "lobby"
+
+# Each worker publishes its own count of open sockets under ws:active:<host>:<pid>;
+# the cluster total is the sum of these keys. The key is rewritten on every connect and
+# disconnect and by a heartbeat well inside the TTL, so it only expires once the worker
+# is gone (crashed or restarted) instead of inflating the total.
+ACTIVE_CONNECTIONS_KEY = f"ws:active:{socket.gethostname()}:{os.getpid()}"
+ACTIVE_CONNECTIONS_TTL = 300
+ACTIVE_CONNECTIONS_REFRESH = 60
+
+# redis.asyncio clients are bound to the event loop that created them
+_redis_clients = weakref.WeakKeyDictionary()
+
+# Strong references to fire-and-forget tasks so they aren't garbage collected mid-flight
+_background_tasks = set()
+
+# One heartbeat task per event loop
+_heartbeat_tasks = {}
+
+
+def get_redis():
+    loop = asyncio.get_running_loop()
+    client = _redis_clients.get(loop)
+    if client is None:
+        client = _redis_clients[loop] = aioredis.from_url(settings.REDIS_URL)
+    return client
+
+
+def _dumps(data):
+    # orjson returns bytes; the browser clients expect text frames
+    return orjson.dumps(data).decode()
+
+
 class ChatConsumer(AsyncWebsocketConsumer):
+    # Open sockets in this worker; single event loop, so no locking is needed
     active_connections = 0
-    
+
     async def connect(self):
+        # Rooms are created on connect, so anonymous sockets must not get that far
+        if not self.scope["user"].is_authenticated:
+            await self.close()
+            return
+
         try:
-            if 'room_name' in self.scope['url_route']['kwargs']:
-                self.room_name = self.scope['url_route']['kwargs']['room_name']
-            else:
-                # Fallback for lobby or other routes without room_name
+            # The lobby is identified by its route, not its name: a group room may be called "lobby"
+            self.is_lobby = 'room_name' not in self.scope['url_route']['kwargs']
+            if self.is_lobby:
                 self.room_name = "lobby"
+            else:
+                self.room_name = self.scope['url_route']['kwargs']['room_name']
                 
-            self.room_group_name = f"chat_{self.room_name}"
+            # Resolve the FKs once; they don't change for the lifetime of the socket
+            self.user_id = self.scope["user"].id
+            self.last_typing_sent = 0.0
 
-            # Join room group
-            await self.channel_layer.group_add(
-                self.room_group_name,
-                self.channel_name
-            )
+            self.room_group_name = LOBBY_GROUP_NAME if self.is_lobby else f"chat_{self.room_name}"
+            self.group_names = [self.room_group_name]
+            if self.is_lobby:
+                # Private notifications are delivered to the lobby socket of the recipient only.
+                # Keyed by id: usernames may contain characters that aren't valid in group names.
+                self.group_names.append(f"user_{self.user_id}")
 
-            # Mark all messages in this room as read by this user
-            read_msg_ids = await self.mark_room_read(self.room_name, self.scope["user"])
-            
-            if read_msg_ids:
-                await self.channel_layer.group_send(
-                    self.room_group_name,
-                    {
-                        "type": "bulk_read",
-                        "message_ids": read_msg_ids,
-                        "username": self.scope["user"].username
-                    }
-                )
+            # Work out the other participant of a private room once instead of per message
+            self.is_private = not self.is_lobby and self.room_name.startswith("private_")
+            self.target_user = self.get_private_target(self.room_name, self.scope["user"].username) if self.is_private else None
+            self.target_user_id = await self.get_user_id(self.target_user) if self.target_user else None
+            self.room_id = await self.get_room_id(self.room_name)
+
+            # Join room group (and user group for the lobby) in one pass
+            await asyncio.gather(*(
+                self.channel_layer.group_add(group_name, self.channel_name)
+                for group_name in self.group_names
+            ))
 
             await self.accept()
+
+            # Mark all messages in this room as read by this user, without holding up the handshake
+            self.read_task = asyncio.create_task(self.read_room_on_connect())
             
             # Track active connections
-            ChatConsumer.active_connections += 1
-            logger.info(f"WebSocket CONNECTED: User={self.scope['user'].username}, Room={self.room_name}, Active connections: {ChatConsumer.active_connections}")
+            active_connections = self.track_connection(1)
+            self.counted = True
+            if logger.isEnabledFor(logging.INFO):
+                logger.info(f"WebSocket CONNECTED: User={self.scope['user'].username}, Room={self.room_name}, Active connections: {active_connections}")
         
         except Exception as e:
             # Log the error but don't show full stack trace for Redis connection issues
-            if "redis" in str(e).lower() or "connection" in str(e).lower():
+            if isinstance(e, (RedisError, OSError)):
                 logger.warning(f"Redis connection issue during WebSocket connect for user {self.scope['user'].username}: {type(e).__name__}")
             else:
                 logger.error(f"Error in WebSocket connect: {e}")
@@ -57,15 +120,20 @@ class ChatConsumer(AsyncWebsocketConsumer):
     async def disconnect(self, close_code):
         # Track active connections - only decrement if we actually connected
         if hasattr(self, 'room_group_name') and hasattr(self, 'room_name'):
-            ChatConsumer.active_connections -= 1
-            logger.info(f"WebSocket DISCONNECTED: User={self.scope['user'].username}, Room={self.room_name}, Code={close_code}, Active connections: {ChatConsumer.active_connections}")
+            active_connections = self.track_connection(-1) if getattr(self, 'counted', False) else None
+            # Don't broadcast read receipts for a socket that is already gone
+            read_task = getattr(self, 'read_task', None)
+            if read_task and not read_task.done():
+                read_task.cancel()
+            if logger.isEnabledFor(logging.INFO):
+                logger.info(f"WebSocket DISCONNECTED: User={self.scope['user'].username}, Room={self.room_name}, Code={close_code}, Active connections: {active_connections}")
             
             # Leave room group
             try:
-                await self.channel_layer.group_discard(
-                    self.room_group_name,
-                    self.channel_name
-                )
+                await asyncio.gather(*(
+                    self.channel_layer.group_discard(group_name, self.channel_name)
+                    for group_name in self.group_names
+                ))
             except Exception as e:
                 # Redis might be down, just log it
                 logger.debug(f"Could not leave group (Redis may be down): {e}")
@@ -73,19 +141,49 @@ class ChatConsumer(AsyncWebsocketConsumer):
             # Connection failed before setup completed
             logger.debug(f"WebSocket disconnected before full setup, Code={close_code}")
 
+    def track_connection(self, delta):
+        ChatConsumer.active_connections += delta
+        # Publish in the background so the handshake doesn't wait on Redis
+        task = asyncio.create_task(self.publish_connection_count())
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+
+        loop = asyncio.get_running_loop()
+        if loop not in _heartbeat_tasks:
+            heartbeat = _heartbeat_tasks[loop] = loop.create_task(self.refresh_connection_count())
+            # Restarted by the next connect if it ever stops (e.g. the loop shuts down)
+            heartbeat.add_done_callback(lambda t: _heartbeat_tasks.pop(loop, None))
+        return ChatConsumer.active_connections
+
+    @staticmethod
+    async def refresh_connection_count():
+        # Keeps the key alive while sockets stay open without any connects or disconnects
+        while True:
+            await asyncio.sleep(ACTIVE_CONNECTIONS_REFRESH)
+            await ChatConsumer.publish_connection_count()
+
+    @staticmethod
+    async def publish_connection_count():
+        # Writes the absolute count, so a lost update is corrected by the next one
+        try:
+            await get_redis().set(ACTIVE_CONNECTIONS_KEY, ChatConsumer.active_connections, ex=ACTIVE_CONNECTIONS_TTL)
+        except RedisError as e:
+            logger.debug(f"Could not publish active connection count: {type(e).__name__}")
+
     # Receive message from WebSocket
     async def receive(self, text_data):
-        data = json.loads(text_data)
+        data = orjson.loads(text_data)
         msg_type = data.get("type", "chat_message")
-        username = data.get("username")
+        # Identify the sender from the authenticated scope, never from the client payload
+        username = self.scope["user"].username
 
         if msg_type == "chat_message":
             message = data["message"]
             # Save message to database
-            msg_id = await self.save_message(username, self.room_name, message)
+            msg_id = await self.save_message(message)
 
             # Send message to room group
-            await self.channel_layer.group_send(
+            sends = [self.channel_layer.group_send(
                 self.room_group_name,
                 {
                     "type": "chat_message",
@@ -93,41 +191,54 @@ class ChatConsumer(AsyncWebsocketConsumer):
                     "username": username,
                     "id": msg_id
                 }
-            )
+            )]
             
-            # Send notification to the lobby
+            # Send notification to the recipient (private) or the whole lobby (group)
             notification_data = {
                 "type": "notification",
                 "sender": username,
                 "message": message,
             }
             
-            if "private" in self.room_name:
+            if self.is_private:
                 # Private Chat Logic
-                parts = self.room_name.split('_')
-                if len(parts) >= 3:
-                    target_user = parts[2] if parts[1] == username else parts[1]
-                    notification_data["target_user"] = target_user
+                if self.target_user_id:
+                    notification_data["target_user"] = self.target_user
                     notification_data["room_type"] = "private"
+                    sends.append(self.channel_layer.group_send(f"user_{self.target_user_id}", notification_data))
             else:
                 # Group Chat Logic
                 notification_data["room_name"] = self.room_name
                 notification_data["room_type"] = "group"
+                sends.append(self.channel_layer.group_send(LOBBY_GROUP_NAME, notification_data))
 
-            await self.channel_layer.group_send("chat_lobby", notification_data)
+            await asyncio.gather(*sends)
         elif msg_type == "typing":
+            is_typing = data.get("is_typing", True)
+            # Drop repeated keystroke events; "stopped typing" is always forwarded
+            if is_typing:
+                now = time.monotonic()
+                if now - self.last_typing_sent < TYPING_DEBOUNCE_SECONDS:
+                    return
+                self.last_typing_sent = now
+            else:
+                self.last_typing_sent = 0.0
             await self.channel_layer.group_send(
                 self.room_group_name,
                 {
                     "type": "user_typing",
                     "username": username,
-                    "is_typing": data.get("is_typing", True)
+                    "is_typing": is_typing
                 }
             )
         elif msg_type == "read_receipt":
-            msg_id = data.get("message_id")
-            if msg_id:
-                await self.mark_message_read(msg_id, username)
+            try:
+                msg_id = int(data.get("message_id"))
+            except (TypeError, ValueError):
+                # The id comes from the client, so it may be missing or malformed
+                logger.warning(f"Ignoring read_receipt with invalid message_id {data.get('message_id')!r}")
+                return
+            if await self.mark_message_read(msg_id, self.user_id):
                 await self.channel_layer.group_send(
                     self.room_group_name,
                     {
@@ -136,18 +247,45 @@ class ChatConsumer(AsyncWebsocketConsumer):
                         "username": username
                     }
                 )
+        elif msg_type == "load_more":
+            # Keyset pagination: return the page of messages older than the oldest one the client has.
+            # Always reply, so the client can re-enable its "load older" control.
+            messages, has_more = [], False
+            try:
+                before_id = int(data.get("before_id"))
+            except (TypeError, ValueError):
+                # The cursor comes from the client, so it may be missing or malformed
+                logger.warning(f"Ignoring load_more with invalid before_id {data.get('before_id')!r}")
+            else:
+                if self.room_id:
+                    messages, has_more = await self.get_message_page(before_id)
+            await self.send(text_data=_dumps({
+                "type": "history",
+                "messages": messages,
+                "has_more": has_more
+            }))
         elif msg_type == "mark_read":
             # Mark all messages in the room as read by this user
-            read_msg_ids = await self.mark_room_read(self.room_name, self.scope["user"])
-            if read_msg_ids:
-                await self.channel_layer.group_send(
-                    self.room_group_name,
-                    {
-                        "type": "bulk_read",
-                        "message_ids": read_msg_ids,
-                        "username": self.scope["user"].username
-                    }
-                )
+            await self.read_room()
+
+    async def read_room(self):
+        read_msg_ids = await self.mark_room_read(self.user_id)
+        if read_msg_ids:
+            await self.channel_layer.group_send(
+                self.room_group_name,
+                {
+                    "type": "bulk_read",
+                    "message_ids": read_msg_ids,
+                    "username": self.scope["user"].username
+                }
+            )
+
+    async def read_room_on_connect(self):
+        # Runs as a background task, so nothing awaits it: failures have to be logged here
+        try:
+            await self.read_room()
+        except Exception:
+            logger.exception(f"Could not mark room {self.room_name} as read on connect")
 
     # Receive message from room group
     async def chat_message(self, event):
@@ -156,7 +294,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
         msg_id = event.get("id")
 
         # Send message to WebSocket
-        await self.send(text_data=json.dumps({
+        await self.send(text_data=_dumps({
             "type": "chat_message",
             "message": message,
             "username": username,
@@ -167,7 +305,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
         username = event["username"]
         is_typing = event["is_typing"]
 
-        await self.send(text_data=json.dumps({
+        await self.send(text_data=_dumps({
             "type": "typing",
             "username": username,
             "is_typing": is_typing
@@ -177,7 +315,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
         message_id = event["message_id"]
         username = event["username"]
 
-        await self.send(text_data=json.dumps({
+        await self.send(text_data=_dumps({
             "type": "read_receipt",
             "message_id": message_id,
             "username": username
@@ -187,7 +325,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
         message_ids = event["message_ids"]
         username = event["username"]
 
-        await self.send(text_data=json.dumps({
+        await self.send(text_data=_dumps({
             "type": "bulk_read",
             "message_ids": message_ids,
             "username": username
@@ -196,50 +334,110 @@ class ChatConsumer(AsyncWebsocketConsumer):
     async def notification(self, event):
         # Forward the entire event data to the WebSocket
         # Remove the 'type' key from event if it conflicts or just pass it along
-        await self.send(text_data=json.dumps(event))
+        await self.send(text_data=_dumps(event))
+
+    @staticmethod
+    def get_private_target(room_name, username):
+        # Room names are "private_<a>_<b>" with sorted usernames, which may themselves contain "_"
+        users = room_name[len("private_"):]
+        if users.startswith(f"{username}_"):
+            return users[len(username) + 1:]
+        if users.endswith(f"_{username}"):
+            return users[:-len(username) - 1]
+        return None
+
+    @database_sync_to_async
+    def get_user_id(self, username):
+        return User.objects.filter(username=username).values_list("id", flat=True).first()
 
     @database_sync_to_async
-    def save_message(self, username, room_name, message_content):
+    def get_room_id(self, room_name):
+        # The lobby has no backing room
+        if self.is_lobby:
+            return None
+        # Ensure room exists (e.g. if it's a new group chat)
+        # Determine type based on name convention or default to group
+        room_type = "private" if self.is_private else "group"
+        room, created = ChatRoom.objects.get_or_create(name=room_name, defaults={"type": room_type})
+        return room.id
+
+    @database_sync_to_async
+    def save_message(self, message_content):
         try:
-            user = User.objects.get(username=username)
-            # Ensure room exists (e.g. if it's a new group chat)
-            # Determine type based on name convention or default to group
-            room_type = "private" if room_name.startswith("private_") else "group"
-            room, created = ChatRoom.objects.get_or_create(name=room_name, defaults={"type": room_type})
-            
-            msg = Message.objects.create(sender=user, room=room, content=message_content)
-            msg.read_by.add(user) # Sender has read their own message
+            # Message and the sender's read_by row are committed together
+            with transaction.atomic():
+                msg = Message.objects.create(sender_id=self.user_id, room_id=self.room_id, content=message_content)
+                # Sender has read their own message
+                Message.read_by.through.objects.create(message_id=msg.id, user_id=self.user_id)
             return msg.id
-        except Exception as e:
-            print(f"Error saving message: {e}")
+        except IntegrityError:
+            # e.g. the sender or room was deleted while the socket was open
+            logger.exception(f"Could not save message in room {self.room_name}")
             return None
 
     @database_sync_to_async
-    def mark_message_read(self, message_id, username):
+    def get_message_page(self, before_id):
+        rows = list(
+            Message.objects.filter(room_id=self.room_id, id__lt=before_id)
+            .annotate(read_count=Count("read_by"))
+            .order_by("-id")
+            .values("id", "content", "timestamp", "sender__username", "read_count")[:MESSAGE_PAGE_SIZE + 1]
+        )
+        messages = []
+        for row in rows[:MESSAGE_PAGE_SIZE]:
+            # Format in TIME_ZONE like the template does, rather than in the browser's time zone
+            timestamp = timezone.localtime(row["timestamp"])
+            messages.append({
+                "id": row["id"],
+                "message": row["content"],
+                "username": row["sender__username"],
+                "date": timestamp.strftime("%Y-%m-%d"),
+                "time": timestamp.strftime("%H:%M"),
+                "is_read": row["read_count"] > 1
+            })
+        # Oldest first, matching the order messages are rendered in
+        messages.reverse()
+        return messages, len(rows) > MESSAGE_PAGE_SIZE
+
+    @database_sync_to_async
+    def mark_message_read(self, message_id, user_id):
         try:
-            user = User.objects.get(username=username)
             message = Message.objects.get(id=message_id)
-            message.read_by.add(user)
-        except Exception as e:
-            print(f"Error marking message read: {e}")
+            message.read_by.add(user_id)
+            return True
+        except Message.DoesNotExist:
+            # The id comes from the client, so it may be stale
+            logger.warning(f"Cannot mark unknown message {message_id!r} as read")
+        except IntegrityError:
+            logger.exception(f"Could not mark message {message_id} as read")
+        return False
 
     @database_sync_to_async
-    def mark_room_read(self, room_name, user):
-        read_msg_ids = []
+    def mark_room_read(self, user_id):
+        # The lobby has no room to mark read
+        if self.is_lobby:
+            return []
+
         try:
-            # If it's the lobby, we don't have a room to mark read
-            if room_name == "lobby":
+            # Only ids are needed; an empty result (the usual case on reconnect) skips the write entirely
+            read_msg_ids = list(
+                Message.objects.filter(room_id=self.room_id)
+                .exclude(read_by=user_id)
+                .exclude(sender_id=user_id)
+                .values_list("id", flat=True)
+            )
+            if not read_msg_ids:
                 return []
-                
-            room = ChatRoom.objects.get(name=room_name)
-            messages = Message.objects.filter(room=room).exclude(read_by=user).exclude(sender=user)
-            for msg in messages:
-                msg.read_by.add(user)
-                read_msg_ids.append(msg.id)
-        except ChatRoom.DoesNotExist:
-            # Room might not exist yet if it's a new group chat being joined via URL
-            # In that case, there are no messages to mark read anyway.
-            pass
-        except Exception as e:
-            print(f"Error marking room read: {e}")
-        return read_msg_ids
\ No newline at end of file
+
+            # Insert all read_by rows in one multi-row INSERT instead of one per message
+            # (bulk_create runs its batches in a single transaction)
+            Through = Message.read_by.through
+            Through.objects.bulk_create(
+                [Through(message_id=msg_id, user_id=user_id) for msg_id in read_msg_ids],
+                ignore_conflicts=True,
+                batch_size=500
+            )
+        except IntegrityError:
+            logger.exception(f"Could not mark room {self.room_name} as read")
+            return []
+        return read_msg_ids
@@ -13,12 +13,21 @@ class Command(BaseCommand):
             {'username': 'charlie', 'password': 'password123'},
         ]
 
+        existing_users = set(
+            User.objects.filter(username__in=[u['username'] for u in users]).values_list('username', flat=True)
+        )
+        new_users = []
         for user_data in users:
-            user, created = User.objects.get_or_create(username=user_data['username'])
-            if created:
-                user.set_password(user_data['password'])
-                user.save()
-                self.stdout.write(self.style.SUCCESS(f"Created user: {user.username}"))
+            if user_data['username'] in existing_users:
+                continue
+            user = User(username=user_data['username'])
+            user.set_password(user_data['password'])
+            new_users.append(user)
+
+        # Insert all new users at once; ignore_conflicts covers users created concurrently
+        User.objects.bulk_create(new_users, ignore_conflicts=True, batch_size=500)
+        for user in new_users:
+            self.stdout.write(self.style.SUCCESS(f"Created user: {user.username}"))
 
         # Create sample group chat rooms
         group_rooms = [
@@ -27,9 +36,17 @@ class Command(BaseCommand):
             {'name': 'Random Topics'},
         ]
 
-        for room_data in group_rooms:
-            room, created = ChatRoom.objects.get_or_create(name=room_data['name'], type='group')
-            if created:
-                self.stdout.write(self.style.SUCCESS(f"Created chat room: {room.name}"))
+        existing_rooms = set(
+            ChatRoom.objects.filter(name__in=[r['name'] for r in group_rooms]).values_list('name', flat=True)
+        )
+        new_rooms = [
+            ChatRoom(name=room_data['name'], type='group')
+            for room_data in group_rooms
+            if room_data['name'] not in existing_rooms
+        ]
+
+        ChatRoom.objects.bulk_create(new_rooms, ignore_conflicts=True, batch_size=500)
+        for room in new_rooms:
+            self.stdout.write(self.style.SUCCESS(f"Created chat room: {room.name}"))
 
         self.stdout.write(self.style.SUCCESS("Sample data created successfully!"))
\ No newline at end of file
@@ -1,6 +1,9 @@
 from django.db import models
 from django.contrib.auth.models import User
 
+# Number of messages loaded per page of room history
+MESSAGE_PAGE_SIZE = 50
+
 class ChatRoom(models.Model):
     ROOM_TYPES = (
         ("private", "Private"),
@@ -23,5 +26,13 @@ class Message(models.Model):
     timestamp = models.DateTimeField(auto_now_add=True)
     read_by = models.ManyToManyField(User, related_name="read_messages", blank=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=["room", "timestamp"]),
+            # History pages are keyset-paginated on id within a room (see MESSAGE_PAGE_SIZE)
+            models.Index(fields=["room", "id"]),
+            models.Index(fields=["room", "sender"]),
+        ]
+
     def __str__(self):
         return f"{self.sender}: {self.content}"
\ No newline at end of file
@@ -1,3 +1,111 @@
-from django.test import TestCase
+from unittest import mock
 
-# Create your tests here.
+import orjson
+from asgiref.sync import async_to_sync
+from django.contrib.auth.models import User
+from django.test import SimpleTestCase, TestCase
+
+from .consumers import ChatConsumer, TYPING_DEBOUNCE_SECONDS
+from .models import ChatRoom, Message, MESSAGE_PAGE_SIZE
+
+
+class PrivateTargetTests(SimpleTestCase):
+    def test_plain_usernames(self):
+        self.assertEqual(ChatConsumer.get_private_target("private_alice_bob", "alice"), "bob")
+        self.assertEqual(ChatConsumer.get_private_target("private_alice_bob", "bob"), "alice")
+
+    def test_underscore_usernames(self):
+        # Room between "a_b" and "b"
+        self.assertEqual(ChatConsumer.get_private_target("private_a_b_b", "a_b"), "b")
+        self.assertEqual(ChatConsumer.get_private_target("private_a_b_b", "b"), "a_b")
+        # Room between "a" and "b_c"
+        self.assertEqual(ChatConsumer.get_private_target("private_a_b_c", "a"), "b_c")
+        self.assertEqual(ChatConsumer.get_private_target("private_a_b_c", "b_c"), "a")
+
+    def test_chat_with_self(self):
+        self.assertEqual(ChatConsumer.get_private_target("private_alice_alice", "alice"), "alice")
+
+    def test_not_a_participant(self):
+        self.assertIsNone(ChatConsumer.get_private_target("private_alice_bob", "carol"))
+
+
+class MessagePageTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username="alice")
+        self.room = ChatRoom.objects.create(name="general", type="group")
+        self.consumer = ChatConsumer()
+        self.consumer.room_id = self.room.id
+
+    def create_messages(self, count):
+        return [
+            Message.objects.create(sender=self.user, room=self.room, content=f"message {i}").id
+            for i in range(count)
+        ]
+
+    def get_page(self, before_id):
+        return async_to_sync(self.consumer.get_message_page)(before_id)
+
+    def test_returns_older_messages_oldest_first(self):
+        ids = self.create_messages(5)
+        messages, has_more = self.get_page(ids[3])
+        self.assertEqual([m["id"] for m in messages], ids[:3])
+        self.assertEqual(messages[0]["message"], "message 0")
+        self.assertEqual(messages[0]["username"], "alice")
+        self.assertFalse(has_more)
+
+    def test_exactly_one_page_left(self):
+        ids = self.create_messages(MESSAGE_PAGE_SIZE + 1)
+        messages, has_more = self.get_page(ids[-1])
+        self.assertEqual([m["id"] for m in messages], ids[:-1])
+        self.assertFalse(has_more)
+
+    def test_more_than_one_page_left(self):
+        ids = self.create_messages(MESSAGE_PAGE_SIZE + 2)
+        messages, has_more = self.get_page(ids[-1])
+        self.assertEqual([m["id"] for m in messages], ids[1:-1])
+        self.assertTrue(has_more)
+
+    def test_nothing_older(self):
+        ids = self.create_messages(3)
+        self.assertEqual(self.get_page(ids[0]), ([], False))
+
+    def test_other_rooms_are_excluded(self):
+        other_room = ChatRoom.objects.create(name="random", type="group")
+        Message.objects.create(sender=self.user, room=other_room, content="elsewhere")
+        ids = self.create_messages(2)
+        messages, has_more = self.get_page(ids[-1] + 1)
+        self.assertEqual([m["id"] for m in messages], ids)
+
+
+class TypingDebounceTests(SimpleTestCase):
+    def setUp(self):
+        self.consumer = ChatConsumer()
+        self.consumer.scope = {"user": mock.Mock(username="alice")}
+        self.consumer.room_group_name = "chat_general"
+        self.consumer.last_typing_sent = 0.0
+        self.consumer.channel_layer = mock.Mock(group_send=mock.AsyncMock())
+
+    def send_typing(self, is_typing, now):
+        with mock.patch("chat.consumers.time.monotonic", return_value=now):
+            async_to_sync(self.consumer.receive)(
+                text_data=orjson.dumps({"type": "typing", "is_typing": is_typing}).decode()
+            )
+
+    def forwarded(self):
+        return [c.args[1]["is_typing"] for c in self.consumer.channel_layer.group_send.call_args_list]
+
+    def test_repeated_typing_within_window_is_dropped(self):
+        self.send_typing(True, now=100.0)
+        self.send_typing(True, now=100.0 + TYPING_DEBOUNCE_SECONDS / 2)
+        self.assertEqual(self.forwarded(), [True])
+
+    def test_typing_after_window_is_forwarded(self):
+        self.send_typing(True, now=100.0)
+        self.send_typing(True, now=100.0 + TYPING_DEBOUNCE_SECONDS)
+        self.assertEqual(self.forwarded(), [True, True])
+
+    def test_stopped_typing_is_always_forwarded_and_resets_window(self):
+        self.send_typing(True, now=100.0)
+        self.send_typing(False, now=100.1)
+        self.send_typing(True, now=100.2)
+        self.assertEqual(self.forwarded(), [True, False, True])
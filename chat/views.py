@@ -1,11 +1,25 @@
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth import login, logout
 from django.contrib.auth.models import User
-from .models import ChatRoom, Message
+from django.db.models import Count
+from .models import ChatRoom, Message, MESSAGE_PAGE_SIZE
 import logging
 
 logger = logging.getLogger(__name__)
 
+def get_latest_messages(chat_room):
+    # Load senders in the same query and count readers up front so the template doesn't query per message.
+    # Only the newest page is rendered; older messages are fetched over the WebSocket ("load_more").
+    latest = list(
+        Message.objects.filter(room=chat_room)
+        .select_related("sender")
+        .only("id", "content", "timestamp", "sender__username")
+        .annotate(read_count=Count("read_by"))
+        .order_by("-id")[:MESSAGE_PAGE_SIZE + 1]
+    )
+    has_more = len(latest) > MESSAGE_PAGE_SIZE
+    return latest[:MESSAGE_PAGE_SIZE][::-1], has_more
+
 def loginPage(request):
     if request.method == "POST":
         username = request.POST.get("username")
@@ -29,25 +43,36 @@ def chatPage(request):
     users = User.objects.exclude(id=request.user.id)
     
     # Calculate unread counts for private chats
+    # Map each private room name to its user so all counts come from one GROUP BY query
+    room_names = {}
     for user in users:
-        # Construct the private room name
         sorted_users = sorted([request.user.username, user.username])
-        room_name = f"private_{sorted_users[0]}_{sorted_users[1]}"
-        
-        # Count messages in this room not read by current user AND not sent by current user
-        unread_count = Message.objects.filter(
-            room__name=room_name,
+        room_names[f"private_{sorted_users[0]}_{sorted_users[1]}"] = user
+
+    # Count messages not read by current user AND not sent by current user, per room
+    private_counts = dict(
+        Message.objects.filter(
+            room__name__in=room_names,
             room__type="private"
-        ).exclude(read_by=request.user).exclude(sender=request.user).count()
-        
-        user.unread_count = unread_count
+        ).exclude(read_by=request.user).exclude(sender=request.user)
+        .values_list("room__name")
+        .annotate(unread_count=Count("id"))
+    )
+
+    for room_name, user in room_names.items():
+        user.unread_count = private_counts.get(room_name, 0)
 
     # Calculate unread counts for public rooms
+    public_counts = dict(
+        Message.objects.filter(
+            room__in=public_rooms
+        ).exclude(read_by=request.user).exclude(sender=request.user)
+        .values_list("room_id")
+        .annotate(unread_count=Count("id"))
+    )
+
     for room in public_rooms:
-        unread_count = Message.objects.filter(
-            room=room
-        ).exclude(read_by=request.user).exclude(sender=request.user).count()
-        room.unread_count = unread_count
+        room.unread_count = public_counts.get(room.id, 0)
 
     return render(request, "chat/landingPage.html", {
         "public_rooms": public_rooms,
@@ -64,12 +89,13 @@ def groupRoomPage(request, room_name):
     if request.user not in chat_room.participants.all():
         chat_room.participants.add(request.user)
 
-    messages = Message.objects.filter(room=chat_room).order_by("timestamp")
+    messages, has_more = get_latest_messages(chat_room)
 
     return render(request, "chat/chatPage.html", {
         "room_name": sanitized_room_name,
         "room_type": "group",
         "messages": messages,
+        "has_more": has_more,
         "current_user": request.user
     })
 
@@ -90,12 +116,13 @@ def privateRoomPage(request, username):
     if other_user not in chat_room.participants.all():
         chat_room.participants.add(other_user)
 
-    messages = Message.objects.filter(room=chat_room).order_by("timestamp")
+    messages, has_more = get_latest_messages(chat_room)
 
     return render(request, "chat/chatPage.html", {
         "room_name": room_name,
         "room_type": "private",
         "other_user": other_user,
         "messages": messages,
+        "has_more": has_more,
         "current_user": request.user
     })
\ No newline at end of file
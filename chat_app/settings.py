@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/6.0/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -43,11 +44,15 @@ INSTALLED_APPS = [
 ]
 ASGI_APPLICATION = 'chat_app.asgi.application'
 
+# REDIS_URL can point at any Redis wire-compatible server (e.g. DragonflyDB).
+REDIS_URL = os.environ.get("REDIS_URL", "redis://127.0.0.1:6379")
+
+# Pub/sub layer: group_send is a single PUBLISH instead of one push per member.
 CHANNEL_LAYERS = {
     "default": {
-        "BACKEND": "channels_redis.core.RedisChannelLayer",
+        "BACKEND": "channels_redis.pubsub.RedisPubSubChannelLayer",
         "CONFIG": {
-            "hosts": [("127.0.0.1", 6379)],
+            "hosts": [REDIS_URL],
         },
     },
 }
@@ -92,6 +97,25 @@ DATABASES = {
     }
 }
 
+# Use PostgreSQL with Django's built-in connection pool when configured (requires psycopg[pool]).
+# Under ASGI, pooling is the supported way to reuse connections; persistent
+# connections (CONN_MAX_AGE) are not, so it stays at its default of 0.
+if os.environ.get('POSTGRES_DB'):
+    DATABASES['default'] = {
+        'ENGINE': 'django.db.backends.postgresql',
+        'NAME': os.environ['POSTGRES_DB'],
+        'USER': os.environ.get('POSTGRES_USER', ''),
+        'PASSWORD': os.environ.get('POSTGRES_PASSWORD', ''),
+        'HOST': os.environ.get('POSTGRES_HOST', '127.0.0.1'),
+        'PORT': os.environ.get('POSTGRES_PORT', '5432'),
+        'OPTIONS': {
+            'pool': {
+                'min_size': 2,
+                'max_size': 20,
+            },
+        },
+    }
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,